@@ -33,7 +33,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import h5py
 import numpy.fft as npf
-import os
+import io
 import subprocess
 import sys
 
@@ -44,13 +44,12 @@ def install(package):
 
 # for downloading files:
 try:
-    # This package is not part of anaconda and may need to be installed.
-    import wget
+    import requests
 except ImportError:
-    print('wget not found.  Will install with pip.')
+    print('requests not found.  Will install with pip.')
     import pip
-    install('wget')
-    import wget
+    install('requests')
+    import requests
 try:
     import pyUSID as usid
 except ImportError:
@@ -65,11 +64,12 @@ except ImportError:
 # When using your own image, you can skip this cell and provide the path to your data as 2D numpy array using the
 # variable - ``image_raw``
 #
-# Coming back to our example, lets start by downloading the file from GitHub:
-h5_path = 'temp.h5'
-# download the data file from Github:
+# Coming back to our example, lets start by downloading the file from GitHub.
+# The file is small enough to be held in memory, so it is never written to disk:
 url = 'https://raw.githubusercontent.com/pycroscopy/pycroscopy/master/data/STEM_STO_2_20.h5'
-_ = wget.download(url, h5_path, bar=None)
+response = requests.get(url)
+response.raise_for_status()
+h5_bytes = io.BytesIO(response.content)
 
 ####################################################################################
 # The image is formatting according to the Universal Spectroscopic and Imaing Data (USID) model and is stored in a
@@ -80,7 +80,7 @@ _ = wget.download(url, h5_path, bar=None)
 # Here, we will load the data out of this standardized format and into numpy using a few simple commands found in our
 # sister software package - ``pyUSID``:
 
-h5_f = h5py.File(h5_path, mode='r')
+h5_f = h5py.File(h5_bytes, mode='r')
 print('Contents of this h5 file:')
 print('-------------------------')
 usid.hdf_utils.print_tree(h5_f)
@@ -286,6 +286,6 @@ for axis, img, title in zip(axes, [image_corrected, filtered_background],
 fig.tight_layout()
 
 ####################################################################################
-# delete the temporarily downloaded file:
+# close the file and release the downloaded bytes:
 h5_f.close()
-os.remove(h5_path)
\ No newline at end of file
+h5_bytes.close()
\ No newline at end of file
@@ -33,7 +33,7 @@ import numpy as np  # fast math
 from warnings import warn
 import matplotlib.pyplot as plt  # plotting
 import h5py  # reading the data file
-import os  # file operations
+import io  # in-memory files
 from scipy import interpolate, stats  # various convenience tools
 from skimage import transform  # image processing and registration
 import subprocess
@@ -42,13 +42,12 @@ import sys
 def install(package):
     subprocess.call([sys.executable, "-m", "pip", "install", package])
 try:
-    # This package is not part of anaconda and may need to be installed.
-    import wget
+    import requests
 except ImportError:
-    warn('wget not found.  Will install with pip.')
+    warn('requests not found.  Will install with pip.')
     import pip
-    install('wget')
-    import wget
+    install('requests')
+    import requests
 try:
     import pyUSID as usid # used mainly for visualization purposes here
 except ImportError:
@@ -132,19 +131,20 @@ def plot_markers(axis, coordinates, colors):
 # --------------------------------
 # We will be using an data file available on our GitHub project page by default. You are encouraged
 # to download this document as a Jupyter Notebook (button at the bottom of the page) and use your own data instead.
-# When using your own data, you can skip this cell and provide the path to your data using the variable - h5_path
+# When using your own data, you can skip this cell and provide the path to your data file to h5py.File in place of h5_bytes
 #
 # We begin by loading the high resolution STM image, the Z component image of the spectroscopic data set, and the
 # spectroscopic data set itself
 
-# Downloading the example file from the pycroscopy Github project
+# Downloading the example file from the pycroscopy Github project straight into memory
 url = 'https://github.com/pycroscopy/pycroscopy/raw/master/data/sts_data_image_registration.h5'
-h5_path = 'temp.h5'
-_ = wget.download(url, h5_path, bar=None)
+response = requests.get(url)
+response.raise_for_status()
+h5_bytes = io.BytesIO(response.content)
 
 ##############################################################################
 # Now let us look at the contents of this file:
-h5_file = h5py.File(h5_path, mode='r')
+h5_file = h5py.File(h5_bytes, mode='r')
 usid.hdf_utils.print_tree(h5_file)
 
 ##############################################################################
@@ -363,5 +363,6 @@ fig.suptitle('Different transforms applied to the images', y=1.03)
 fig.tight_layout()
 
 ##############################################################################
-# delete the h5_file
-os.remove(h5_path)
+# close the h5_file and release the downloaded bytes
+h5_file.close()
+h5_bytes.close()
@@ -40,8 +40,8 @@ import h5py
 import matplotlib.pyplot as plt
 
 # for downloading files:
-import wget
-import os
+import requests
+import io
 
 # multivariate analysis:
 from sklearn.cluster import KMeans
@@ -83,14 +83,15 @@ from pycroscopy.viz import cluster_utils
 #
 # We will be using an data file available on our GitHub project page by default. You are encouraged
 # to download this document as a Jupyter Notebook (button at the bottom of the page) and use your own data instead.
-# When using your own data, you can skip this cell and provide the path to your data using the variable - data_file_path
+# When using your own data, you can skip this cell and provide the path to your data file to h5py.File in place of h5_bytes
 
-data_file_path = 'temp_um.h5'
-# download the data file from Github:
+# download the data file from Github straight into memory. Results written below also stay in memory:
 url = 'https://raw.githubusercontent.com/pycroscopy/pycroscopy/master/data/BELine_0004.h5'
-data_file_path = wget.download(url, data_file_path, bar=None)
+response = requests.get(url)
+response.raise_for_status()
+h5_bytes = io.BytesIO(response.content)
 
-h5_file = h5py.File(data_file_path, mode='r+')
+h5_file = h5py.File(h5_bytes, mode='r+')
 
 print('Contents of data file:')
 print('----------------------')
@@ -221,6 +222,6 @@ axis.legend(bbox_to_anchor=[1.0, 1.0], fontsize=12)
 
 #####################################################################################
 
-# Close and delete the h5_file
+# Close the h5_file and release the downloaded bytes
 h5_file.close()
-os.remove(data_file_path)
+h5_bytes.close()
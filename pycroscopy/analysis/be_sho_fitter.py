@@ -9,8 +9,15 @@ Created on 7/17/16 10:08 AM
 from __future__ import division, print_function, absolute_import, unicode_literals
 from warnings import warn
 import numpy as np
+from numba import config
+try:
+    from numba import get_num_threads, set_num_threads
+except ImportError:
+    # numba < 0.49, the last releases for Python 2.7 and 3.5, always runs parallel kernels on all its threads
+    get_num_threads = set_num_threads = None
 
 from .fitter import Fitter
+from .guess_methods import GuessMethods
 from pyUSID import USIDataset
 from pyUSID.io.hdf_utils import copy_region_refs, write_simple_attrs, create_results_group, write_reduced_spec_dsets, \
                                 create_empty_dataset, get_auxiliary_datasets, write_main_dataset
@@ -22,6 +29,19 @@ field_names = ['Amplitude [V]', 'Frequency [Hz]', 'Quality Factor', 'Phase [rad]
 sho32 = np.dtype({'names': field_names,
                   'formats': [np.float32 for name in field_names]})
 
+# Guess results are written by viewing rows of float32 values as sho32 which requires all fields to be packed
+assert sho32.itemsize == 4 * len(field_names)
+assert [sho32.fields[name][1] for name in field_names] == list(range(0, 4 * len(field_names), 4))
+
+'''
+Compact dtype for the Guess dataset, which only serves as a starting point for the fit.
+The phase (within [-pi, pi]) and R^2 are stored at half precision. R^2 has no lower bound, so the R^2 of exceptionally
+poor guesses, below the float16 limit of -65504, is stored as -inf. The amplitude, frequency (in Hz, well beyond the
+range of float16) and quality factor are left at single precision.
+'''
+sho_compact = np.dtype({'names': field_names,
+                        'formats': [np.float32, np.float32, np.float32, np.float16, np.float16]})
+
 
 class BESHOfitter(Fitter):
     """
@@ -55,10 +75,15 @@ class BESHOfitter(Fitter):
         self._fitter_name = "SHO_Fit"
         self._parms_dict = None
         self._fit_dim_name = variables[0]
+        self._guess_dtype = sho32
+
+        # Read the spectroscopic ancillary datasets once. They are small and are needed repeatedly below
+        self._spec_inds = self.h5_main.h5_spec_inds[()]
+        self._spec_vals = self.h5_main.h5_spec_vals[()]
 
         # Extract some basic parameters that are necessary for either the guess or fit
         freq_dim_ind = self.h5_main.spec_dim_labels.index(variables[0])
-        self.step_start_inds = np.where(self.h5_main.h5_spec_inds[freq_dim_ind] == 0)[0]
+        self.step_start_inds = np.where(self._spec_inds[freq_dim_ind] == 0)[0]
         self.num_udvs_steps = len(self.step_start_inds)
 
         # find the frequency vector and hold in memory
@@ -81,16 +106,39 @@ class BESHOfitter(Fitter):
         h5_sho_inds, h5_sho_vals = write_reduced_spec_dsets(h5_group, self.h5_main.h5_spec_inds,
                                                             self.h5_main.h5_spec_vals, self._fit_dim_name)
 
+        # Target ~1 MB per HDF5 chunk rather than one chunk per position, which costs a B-tree lookup per position
+        chunk_rows = max(1, min(self.h5_main.shape[0],
+                                (1 << 20) // (self.num_udvs_steps * self._guess_dtype.itemsize)))
+
         self.h5_guess = write_main_dataset(h5_group, (self.h5_main.shape[0], self.num_udvs_steps), 'Guess', 'SHO',
                                            'compound', None, None, h5_pos_inds=self.h5_main.h5_pos_inds,
                                            h5_pos_vals=self.h5_main.h5_pos_vals, h5_spec_inds=h5_sho_inds,
-                                           h5_spec_vals=h5_sho_vals, chunks=(1, self.num_udvs_steps), dtype=sho32,
+                                           h5_spec_vals=h5_sho_vals, chunks=(chunk_rows, self.num_udvs_steps),
+                                           dtype=self._guess_dtype,
                                            main_dset_attrs=self._parms_dict, verbose=self._verbose)
 
         write_simple_attrs(self.h5_guess, {'SHO_guess_method': "pycroscopy BESHO", 'last_pixel': 0})
 
         copy_region_refs(self.h5_main, self.h5_guess)
 
+    def _check_for_old_guess(self):
+        """
+        Same as :meth:`~pycroscopy.analysis.fitter.Fitter._check_for_old_guess` but only returns Guess datasets stored
+        with the dtype requested via `compact_guess` in :meth:`do_guess`, so that a compact Guess is never returned when
+        a full precision one was requested or vice versa
+
+        Returns
+        -------
+        partial_dsets : list
+            Partially computed Guess datasets
+        completed_dsets : list
+            Completed Guess datasets
+        """
+        partial_dsets, completed_dsets = super(BESHOfitter, self)._check_for_old_guess()
+        partial_dsets = [dset for dset in partial_dsets if dset.dtype == self._guess_dtype]
+        completed_dsets = [dset for dset in completed_dsets if dset.dtype == self._guess_dtype]
+        return partial_dsets, completed_dsets
+
     def _create_fit_datasets(self):
         """
         Creates the HDF5 fit dataset. pycroscopy requires that the h5 group, guess dataset,
@@ -103,13 +151,6 @@ class BESHOfitter(Fitter):
             warn('Need to guess before fitting!')
             return
 
-        if self.step_start_inds is None:
-            h5_spec_inds = self.h5_main.h5_spec_inds
-            self.step_start_inds = np.where(h5_spec_inds[0] == 0)[0]
-
-        if self.num_udvs_steps is None:
-            self.num_udvs_steps = len(self.step_start_inds)
-
         if self.freq_vec is None:
             self._get_frequency_vector()
 
@@ -132,15 +173,14 @@ class BESHOfitter(Fitter):
         This assumes that the data is reshape-able.
         
         """
-        h5_spec_vals = self.h5_main.h5_spec_vals
         freq_dim = np.argwhere('Frequency' == np.array(self.h5_main.spec_dim_labels)).squeeze()
 
         if len(self.step_start_inds) == 1:  # BE-Line
-            end_ind = h5_spec_vals.shape[1]
+            end_ind = self._spec_vals.shape[1]
         else:  # BEPS
             end_ind = self.step_start_inds[1]
 
-        self.freq_vec = h5_spec_vals[freq_dim, self.step_start_inds[0]:end_ind]
+        self.freq_vec = self._spec_vals[freq_dim, self.step_start_inds[0]:end_ind]
 
     def _get_data_chunk(self):
         """
@@ -170,7 +210,8 @@ class BESHOfitter(Fitter):
         # else:
         #     self.guess = self.h5_guess[self._start_pos:self._end_pos, :]
         self._end_pos = int(min(self.h5_main.shape[0], self._start_pos + self._max_pos_per_read))
-        self.guess = self.h5_guess[self._start_pos:self._end_pos, :]
+        start, end = self._get_rank_bounds()
+        self.guess = self.h5_guess[start:end, :]
         # At this point the self.data object is the raw data that needs to be reshaped to a single UDVS step:
         self.guess = reshape_to_one_step(self.guess, self.num_udvs_steps)
         # don't keep the R^2.
@@ -195,6 +236,9 @@ class BESHOfitter(Fitter):
             self.guess = reshape_to_n_steps(self.guess, self.num_udvs_steps)
             if self._verbose:
                 print('Reshaped guess to shape {}'.format(self.guess.shape))
+            # The guess dataset may be stored at a lower precision than sho32. R^2 beyond the float16 range becomes -inf
+            with np.errstate(over='ignore'):
+                self.guess = self.guess.astype(self.h5_guess.dtype, copy=False)
         else:
             self.fit = np.transpose(np.atleast_2d(self.fit))
             self.fit = reshape_to_n_steps(self.fit, self.num_udvs_steps)
@@ -202,9 +246,43 @@ class BESHOfitter(Fitter):
         # ask super to take care of the rest, which is a standardized operation
         super(BESHOfitter, self)._set_results(is_guess)
 
+    def _compute_guess(self, processors, strategy, options):
+        """
+        Computes guesses for the chunk of data currently in memory. The complex_gaussian strategy is computed for
+        all spectra in the chunk at once using threads that share memory rather than by pickling each spectrum out
+        to worker processes.
+
+        Parameters
+        ----------
+        processors : int
+            Number of cores to use for computing
+        strategy : str
+            Name of the guess strategy in :class:`~pycroscopy.analysis.guess_methods.GuessMethods`
+        options : dict
+            Dictionary of options passed to strategy
+
+        Returns
+        -------
+        results : array-like
+            Guess results for each spectrum in `self.data`
+        """
+        if strategy != 'complex_gaussian':
+            return super(BESHOfitter, self)._compute_guess(processors, strategy, options)
+
+        if set_num_threads is None:
+            return GuessMethods.complex_gaussian_batch(self.data, **options)
+
+        # The thread count is global to numba, so leave it as found for the rest of the process
+        orig_num_threads = get_num_threads()
+        set_num_threads(max(1, min(processors, config.NUMBA_NUM_THREADS)))
+        try:
+            return GuessMethods.complex_gaussian_batch(self.data, **options)
+        finally:
+            set_num_threads(orig_num_threads)
+
     def do_guess(self, max_mem=None, processors=None, strategy='complex_gaussian',
                  options={"peak_widths": np.array([10, 200]), "peak_step": 20},
-                 h5_partial_guess=None, override=False, **kwargs):
+                 h5_partial_guess=None, override=False, compact_guess=False, **kwargs):
         """
 
         Parameters
@@ -227,6 +305,9 @@ class BESHOfitter(Fitter):
         override : bool, optional. default = False
             By default, will simply return duplicate results to avoid recomputing or resume computation on a
             group with partial results. Set to True to force fresh computation.
+        compact_guess : bool, optional. default = False
+            If True, a newly created Guess dataset stores the phase and R^2 at half precision (see `sho_compact`),
+            reducing the size of the dataset by a fifth. Note that BELoopFitter requires sho32 datasets
 
         Returns
         -------
@@ -241,6 +322,7 @@ class BESHOfitter(Fitter):
         """
         if strategy == 'complex_gaussian':
             options.update({'frequencies': self.freq_vec})
+        self._guess_dtype = sho_compact if compact_guess else sho32
         super(BESHOfitter, self).do_guess(processors=processors, strategy=strategy, options=options,
                                           h5_partial_guess=h5_partial_guess, override=override)
 
@@ -310,6 +392,13 @@ class BESHOfitter(Fitter):
         """
         if self._verbose:
             print('Strategy to use: {}'.format(strategy))
+        if strategy in ['complex_gaussian']:
+            # Each row already holds the fields of sho32 in order. View instead of copying field by field
+            sho_vec = np.ascontiguousarray(results, dtype=np.float32).view(sho32).reshape(-1)
+            if self._verbose:
+                print('Raw results and compound SHO vector of shape {}'.format(sho_vec.shape))
+            return sho_vec
+
         # Create an empty array to store the guess parameters
         sho_vec = np.zeros(shape=(len(results)), dtype=sho32)
         if self._verbose:
@@ -342,13 +431,6 @@ class BESHOfitter(Fitter):
             # Add something here for the R^2
             sho_vec['R2 Criterion'] = np.array([self.r_square(self.data, self._sho_func, self.freq_vec, sho_parms)
                                                 for sho_parms in sho_vec])
-        elif strategy in ['complex_gaussian']:
-            for iresult, result in enumerate(results):
-                sho_vec['Amplitude [V]'][iresult] = result[0]
-                sho_vec['Frequency [Hz]'][iresult] = result[1]
-                sho_vec['Quality Factor'][iresult] = result[2]
-                sho_vec['Phase [rad]'][iresult] = result[3]
-                sho_vec['R2 Criterion'][iresult] = result[4]
         elif strategy in ['SHO']:
             for iresult, result in enumerate(results):
                 sho_vec['Amplitude [V]'][iresult] = result.x[0]
@@ -13,6 +13,11 @@ import psutil
 import scipy
 import h5py
 import time as tm
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport - results are written synchronously
+    ThreadPoolExecutor = None
 from .guess_methods import GuessMethods
 from .fit_methods import Fit_Methods
 from pyUSID import USIDataset
@@ -30,7 +35,7 @@ class Fitter(object):
     This abstract class should be extended to cover different types of imaging modalities.
     """
 
-    def __init__(self, h5_main, variables=['Frequency'], parallel=True, verbose=False):
+    def __init__(self, h5_main, variables=['Frequency'], parallel=True, verbose=False, comm=None):
         """
         For now, we assume that the guess dataset has not been generated for this dataset but we will relax this
         requirement after testing the basic components.
@@ -46,6 +51,10 @@ class Fitter(object):
             Should the parallel implementation of the fitting be used.  Default True
         verbose : bool, optional. default = False
             Whether or not to print statements that aid in debugging
+        comm : mpi4py.MPI.Comm, optional. default = None
+            MPI communicator over which the computation should be split. Each rank computes an equal share, in whole
+            HDF5 chunks, of every chunk of positions and all ranks write their results to the file collectively. The
+            file containing `h5_main` must have been opened by all ranks with ``driver='mpio'`` and this communicator
 
         """
 
@@ -59,6 +68,16 @@ class Fitter(object):
         else:
             raise ValueError('Provided dataset is not a "Main" dataset with necessary ancillary datasets')
 
+        if comm is not None and h5_main.file.driver != 'mpio':
+            raise ValueError('The file containing h5_main must be opened with the "mpio" driver when a comm is provided')
+        self._comm = comm
+        # Rows per HDF5 chunk of the dataset being written. Ranks split each chunk of positions along these
+        self._rows_per_chunk = 1
+
+        # Background writer that lets the next chunk be computed while the previous one is written to file
+        self._write_executor = None
+        self._pending_write = None
+
         # Checking if parallel processing will be used
         self._parallel = parallel
         self._verbose = verbose
@@ -128,13 +147,60 @@ class Fitter(object):
         """
         return np.all(np.isin(variables, h5_main.spec_dim_labels))
 
+    def _align_reads_to_chunks(self, h5_dset):
+        """
+        Shrinks the number of positions read per chunk to a multiple of the number of rows per HDF5 chunk of the
+        dataset that results will be written to, so that writing a chunk of results never straddles HDF5 chunks.
+        Under MPI, each rank's share of a chunk of positions is also made up of whole HDF5 chunks.
+
+        Parameters
+        ----------
+        h5_dset : h5py.Dataset
+            Dataset that results will be written to
+        """
+        if h5_dset.chunks is None:
+            self._rows_per_chunk = 1
+            return
+        rows_per_chunk = h5_dset.chunks[0]
+        self._rows_per_chunk = rows_per_chunk
+        if self._max_pos_per_read > rows_per_chunk:
+            self._max_pos_per_read -= self._max_pos_per_read % rows_per_chunk
+        if self._verbose:
+            print('Reading {} pixels per chunk to align with HDF5 chunks of {} rows'.format(self._max_pos_per_read,
+                                                                                           rows_per_chunk))
+
+    def _get_rank_bounds(self):
+        """
+        Returns the range of positions within the current chunk (`self._start_pos` to `self._end_pos`) that this
+        MPI rank is responsible for. This is the entire chunk when no communicator was provided. Otherwise, the
+        chunk is split between ranks along the HDF5 chunks of the dataset being written, so some ranks may get no
+        positions at all.
+
+        Returns
+        -------
+        start : int
+            Index of the first position handled by this rank
+        end : int
+            Index after the last position handled by this rank
+        """
+        if self._comm is None:
+            return self._start_pos, self._end_pos
+        rank = self._comm.Get_rank()
+        size = self._comm.Get_size()
+        # Hand out whole HDF5 chunks so that no two ranks write to the same one
+        first_block = self._start_pos // self._rows_per_chunk
+        num_blocks = -(-self._end_pos // self._rows_per_chunk) - first_block
+        bounds = [(first_block + ind * num_blocks // size) * self._rows_per_chunk for ind in [rank, rank + 1]]
+        return tuple(min(max(bound, self._start_pos), self._end_pos) for bound in bounds)
+
     def _get_data_chunk(self):
         """
         Reads the next chunk of data for the guess or the fit into memory
         """
         if self._start_pos < self.h5_main.shape[0]:
             self._end_pos = int(min(self.h5_main.shape[0], self._start_pos + self._max_pos_per_read))
-            self.data = self.h5_main[self._start_pos:self._end_pos, :]
+            start, end = self._get_rank_bounds()
+            self.data = self.h5_main[start:end, :]
             if self._verbose:
                 print('\nReading pixels {} to {} of {}'.format(self._start_pos, self._end_pos, self.h5_main.shape[0]))
 
@@ -159,9 +225,8 @@ class Fitter(object):
         """
         if self.data is None:
             self._end_pos = int(min(self.h5_main.shape[0], self._start_pos + self._max_pos_per_read))
-            self.guess = self.h5_guess[self._start_pos:self._end_pos, :]
-        else:
-            self.guess = self.h5_guess[self._start_pos:self._end_pos, :]
+        start, end = self._get_rank_bounds()
+        self.guess = self.h5_guess[start:end, :]
 
         if self._verbose:
             print('Guess of shape: {}'.format(self.guess.shape))
@@ -187,21 +252,89 @@ class Fitter(object):
             targ_dset = self.h5_fit
             source_dset = self.fit
 
-        if self._verbose:
-            print('Writing data to positions: {} to {}'.format(self._start_pos, self._end_pos))
-        targ_dset[self._start_pos: self._end_pos, :] = source_dset
+        start, end = self._get_rank_bounds()
 
-        # This flag will let us resume the computation if it is aborted
-        targ_dset.attrs['last_pixel'] = self._end_pos
+        # Only one chunk is ever in flight. Waiting here also surfaces any error raised by the previous write
+        self._wait_for_write()
+
+        if self._comm is None and ThreadPoolExecutor is not None:
+            # Parallel HDF5 is not thread safe, so only serial files are written in the background
+            if self._write_executor is None:
+                self._write_executor = ThreadPoolExecutor(max_workers=1)
+            self._pending_write = self._write_executor.submit(self._write_chunk, targ_dset, source_dset, start, end,
+                                                              self._end_pos, statement)
+        else:
+            self._write_chunk(targ_dset, source_dset, start, end, self._end_pos, statement)
 
         # Now update the start position
         self._start_pos = self._end_pos
 
+    def _write_chunk(self, targ_dset, source_dset, start, end, last_pixel, statement):
+        """
+        Writes a chunk of results to file and updates the book-keeping attribute needed to resume the computation
+
+        Parameters
+        ----------
+        targ_dset : h5py.Dataset
+            Guess or fit dataset to write to
+        source_dset : numpy.ndarray
+            Results for positions start to end
+        start : int
+            First position written by this rank
+        end : int
+            Position after the last one written by this rank
+        last_pixel : int
+            Position after the last one in the chunk across all ranks
+        statement : str
+            'guess' or 'fit'. Only used for the logs
+        """
+        if self._verbose:
+            print('Writing data to positions: {} to {}'.format(start, end))
+        if self._comm is None:
+            targ_dset[start: end, :] = source_dset
+        else:
+            # All ranks write their share of the chunk in a single collective operation
+            with targ_dset.collective:
+                if end > start:
+                    targ_dset[start: end, :] = source_dset
+                else:
+                    # h5py issues no write at all for an empty slice, yet every rank must take part in a
+                    # collective write or the others block forever. Write an explicitly empty selection instead
+                    file_space = targ_dset.id.get_space()
+                    file_space.select_none()
+                    mem_space = h5py.h5s.create_simple((1,))
+                    mem_space.select_none()
+                    targ_dset.id.write(mem_space, file_space, np.zeros(1, dtype=targ_dset.dtype),
+                                       dxpl=targ_dset._dxpl)
+
+        # This flag will let us resume the computation if it is aborted
+        targ_dset.attrs['last_pixel'] = last_pixel
+
         # flush the file
         self.h5_main.file.flush()
         if self._verbose:
             print('Finished writing ' + statement + ' results (chunk) to file!')
 
+    def _wait_for_write(self):
+        """
+        Blocks until the chunk being written in the background, if any, is on file
+        """
+        if self._pending_write is not None:
+            pending, self._pending_write = self._pending_write, None
+            # Re-raises any exception from the writer
+            pending.result()
+
+    def _finish_writes(self):
+        """
+        Waits for all background writes to complete and shuts down the writer
+        """
+        try:
+            self._wait_for_write()
+        finally:
+            if self._write_executor is not None:
+                self._write_executor.shutdown(wait=True)
+                self._write_executor = None
+
     def _create_guess_datasets(self):
         """
         Model specific call that will write the h5 group, guess dataset, corresponding spectroscopic datasets and also
@@ -351,6 +484,8 @@ class Fitter(object):
             self._start_pos = 0
             self._create_guess_datasets()
 
+        self._align_reads_to_chunks(self.h5_guess)
+
         # ################## BEGIN THE ACTUAL COMPUTING #######################################
 
         if processors is None:
@@ -369,39 +504,76 @@ class Fitter(object):
               '\tIf you are operating in a python console, press Ctrl+C or Cmd+C to abort\n'
               '\tIf you are in a Jupyter notebook, click on "Kernel">>"Interrupt"\n')
 
-        self._get_data_chunk()
-        while self.data is not None:
-
-            t_start = tm.time()
-
-            opt = Optimize(data=self.data, parallel=self._parallel)
-            temp = opt.computeGuess(processors=processors, strategy=strategy, options=options)
+        # Join the background writer even if the computation is aborted (Ctrl+C) or fails, so that no
+        # write is left running and any error it raised is not lost
+        try:
+            self._get_data_chunk()
+            while self.data is not None:
 
-            # reorder to get one numpy array out
-            temp = self._reformat_results(temp, strategy)
-            self.guess = np.hstack(tuple(temp))
+                t_start = tm.time()
 
-            # Write to file
-            self._set_results(is_guess=True)
+                if self.data.shape[0] == 0:
+                    # This MPI rank owns no positions in this chunk but must still take part in writing it
+                    self.guess = np.zeros(0, dtype=self.h5_guess.dtype)
+                else:
+                    temp = self._compute_guess(processors, strategy, options)
 
-            # basic timing logs
-            tot_time = np.round(tm.time() - t_start, decimals=2)  # in seconds
-            if self._verbose:
-                print('Done parallel computing in {} or {} per pixel'.format(format_time(tot_time),
-                                                                             format_time(tot_time / self.data.shape[0])))
-            if self._start_pos == orig_start_pos:
-                time_per_pix = tot_time / self._end_pos  # in seconds
-            else:
-                time_remaining = (num_pos - self._end_pos) * time_per_pix  # in seconds
-                print('Time remaining: ' + format_time(time_remaining))
+                    # reorder to get one numpy array out
+                    temp = self._reformat_results(temp, strategy)
+                    if isinstance(temp, np.ndarray) and temp.ndim == 1:
+                        # Already flat. Avoid splitting into and re-joining a tuple of rows
+                        self.guess = temp
+                    else:
+                        self.guess = np.hstack(tuple(temp))
+
+                # Write to file
+                self._set_results(is_guess=True)
+
+                # basic timing logs
+                tot_time = np.round(tm.time() - t_start, decimals=2)  # in seconds
+                if self._verbose:
+                    # An MPI rank may own no positions in this chunk
+                    time_per_pos = tot_time / max(1, self.data.shape[0])
+                    print('Done parallel computing in {} or {} per pixel'.format(format_time(tot_time),
+                                                                                 format_time(time_per_pos)))
+                if self._start_pos == orig_start_pos:
+                    time_per_pix = tot_time / self._end_pos  # in seconds
+                else:
+                    time_remaining = (num_pos - self._end_pos) * time_per_pix  # in seconds
+                    print('Time remaining: ' + format_time(time_remaining))
 
-            # get next batch of data
-            self._get_data_chunk()
+                # get next batch of data
+                self._get_data_chunk()
+        finally:
+            self._finish_writes()
 
         print('Completed computing guess')
         print()
         return USIDataset(self.h5_guess)
 
+    def _compute_guess(self, processors, strategy, options):
+        """
+        Computes the guesses for the chunk of data currently held in `self.data`.
+        By default, each position is handed to the guess function in a separate job.
+        Classes that extend this class may override this to use a faster, model specific, implementation.
+
+        Parameters
+        ----------
+        processors : int
+            Number of cores to use for computing
+        strategy : str
+            Name of the guess strategy in :class:`~pycroscopy.analysis.guess_methods.GuessMethods`
+        options : dict
+            Dictionary of options passed to strategy
+
+        Returns
+        -------
+        results : list
+            Guess results for each position in `self.data`
+        """
+        opt = Optimize(data=self.data, parallel=self._parallel)
+        return opt.computeGuess(processors=processors, strategy=strategy, options=options)
+
     def _reformat_results(self, results, strategy='wavelet_peaks'):
         """
         Model specific restructuring / reformatting of the parallel compute results
@@ -603,6 +775,8 @@ class Fitter(object):
             else:
                 raise ValueError('Please provide a completed guess or partially completed Fit to resume')
 
+        self._align_reads_to_chunks(self.h5_fit)
+
         # ################## BEGIN THE ACTUAL FITTING #######################################
 
         print("Using solver %s and objective function %s to fit your data\n" % (solver_type, obj_func['obj_func']))
@@ -622,39 +796,50 @@ class Fitter(object):
               '\tIf you are in a Jupyter notebook, click on "Kernel">>"Interrupt"\n')
 
         self._get_guess_chunk()
-        self._get_data_chunk()
-
-        while self.data is not None:
 
-            t_start = tm.time()
-
-            opt = Optimize(data=self.data, guess=self.guess, parallel=self._parallel)
-            temp = opt.computeFit(processors=processors, solver_type=solver_type, solver_options=solver_options,
-                                  obj_func=obj_func.copy())
-
-            # TODO: need a different .reformatResults to process fitting results
-            # reorder to get one numpy array out
-            temp = self._reformat_results(temp, obj_func_name)
-            self.fit = np.hstack(tuple(temp))
+        # Join the background writer even if the computation is aborted (Ctrl+C) or fails, so that no
+        # write is left running and any error it raised is not lost
+        try:
+            self._get_data_chunk()
 
-            # Write to file
-            self._set_results(is_guess=False)
+            while self.data is not None:
 
-            # basic timing logs
-            tot_time = np.round(tm.time() - t_start, decimals=2)  # in seconds
-            if self._verbose:
-                print('Done parallel computing in {} or {} per pixel'.format(format_time(tot_time),
-                                                                             format_time(
-                                                                                 tot_time / self.data.shape[0])))
-            if self._start_pos == orig_start_pos:
-                time_per_pix = tot_time / self._end_pos  # in seconds
-            else:
-                time_remaining = (num_pos - self._end_pos) * time_per_pix  # in seconds
-                print('Time remaining: ' + format_time(time_remaining))
+                t_start = tm.time()
 
-            # get next batch of data
-            self._get_guess_chunk()
-            self._get_data_chunk()
+                if self.data.shape[0] == 0:
+                    # This MPI rank owns no positions in this chunk but must still take part in writing it
+                    self.fit = np.zeros(0, dtype=self.h5_fit.dtype)
+                else:
+                    opt = Optimize(data=self.data, guess=self.guess, parallel=self._parallel)
+                    temp = opt.computeFit(processors=processors, solver_type=solver_type,
+                                          solver_options=solver_options, obj_func=obj_func.copy())
+
+                    # TODO: need a different .reformatResults to process fitting results
+                    # reorder to get one numpy array out
+                    temp = self._reformat_results(temp, obj_func_name)
+                    self.fit = np.hstack(tuple(temp))
+
+                # Write to file
+                self._set_results(is_guess=False)
+
+                # basic timing logs
+                tot_time = np.round(tm.time() - t_start, decimals=2)  # in seconds
+                if self._verbose:
+                    # An MPI rank may own no positions in this chunk
+                    time_per_pos = tot_time / max(1, self.data.shape[0])
+                    print('Done parallel computing in {} or {} per pixel'.format(format_time(tot_time),
+                                                                                 format_time(time_per_pos)))
+                if self._start_pos == orig_start_pos:
+                    time_per_pix = tot_time / self._end_pos  # in seconds
+                else:
+                    time_remaining = (num_pos - self._end_pos) * time_per_pix  # in seconds
+                    print('Time remaining: ' + format_time(time_remaining))
+
+                # get next batch of data
+                self._get_guess_chunk()
+                self._get_data_chunk()
+        finally:
+            self._finish_writes()
 
         print('Completed computing fit. Writing to file.')
 
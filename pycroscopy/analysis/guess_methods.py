@@ -10,7 +10,7 @@ from warnings import warn
 
 import numpy as np
 from scipy.signal import find_peaks_cwt
-from .utils.be_sho import SHOestimateGuess, SHOfunc
+from .utils.be_sho import SHOestimateGuess, SHOestimateGuessBatch, SHOrSquaredBatch, SHOfunc
 
 
 class GuessMethods(object):
@@ -128,13 +128,44 @@ class GuessMethods(object):
         """
         w_vec = kwargs.pop('frequencies')
         num_points = kwargs.pop('num_points', 5)
+        polish = kwargs.pop('polish', False)
 
-        guess = SHOestimateGuess(resp_vec, w_vec, num_points)
+        guess = SHOestimateGuess(resp_vec, w_vec, num_points, polish=polish)
 
         guess = np.hstack([guess, np.array(r_square(resp_vec, SHOfunc, guess, w_vec))])
 
         return guess
 
+    @staticmethod
+    def complex_gaussian_batch(resp_mat, *args, **kwargs):
+        """
+        Same as :meth:`complex_gaussian` but operates on all spectra (rows) of `resp_mat` at once, in parallel,
+        within the calling process.
+
+        Parameters
+        ----------
+        resp_mat : numpy.ndarray
+            2D array of data vectors to be fit arranged as (spectra, frequency)
+        args: numpy arrays.
+
+        kwargs: Passed to SHOestimateGuessBatch().
+
+        Returns
+        -------
+        guess_mat : numpy.ndarray
+            2D float32 array arranged as (spectra, [amplitude, frequency, quality factor, phase, R^2])
+        """
+        w_vec = kwargs.pop('frequencies')
+        num_points = kwargs.pop('num_points', 5)
+        polish = kwargs.pop('polish', False)
+
+        # The guesses and R^2 are written straight into the buffer that is handed to the file
+        guess_mat = np.empty((resp_mat.shape[0], 5), dtype=np.float32)
+        SHOestimateGuessBatch(resp_mat, w_vec, num_points, out=guess_mat[:, :4], polish=polish)
+        SHOrSquaredBatch(resp_mat, w_vec, guess_mat[:, :4], out=guess_mat[:, 4])
+
+        return guess_mat
+
 
 def r_square(data_vec, func, *args, **kwargs):
     """
@@ -6,8 +6,42 @@ Created on Mon Sep 28 11:35:57 2015
 """
 
 from __future__ import division, print_function, absolute_import, unicode_literals
+import math
 import numpy as np
-from numpy import exp, abs, sqrt, sum, real, imag, arctan2, append
+from numpy import exp
+from scipy.optimize import least_squares
+from numba import njit, prange, vectorize, types
+try:
+    from numba import cuda
+except ImportError:
+    cuda = None
+
+# All CPU kernels below are compiled with cache=True. The machine code is written next to this module the first
+# time each kernel is called with a given precision and loaded from there by later runs and worker processes, which
+# serves the purpose of ahead-of-time compilation without a compiler at install time
+
+# Allow LLVM to reorder and contract floating point operations but keep IEEE semantics for inf / nan since
+# degenerate pairs can produce either
+_FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# Upper bound on evaluations of the SHO model when refining a guess that the fast estimate could not provide
+_POLISH_MAX_NFEV = 20
+
+# Spectra handed to each CPU thread at a time. Scratch space is allocated once per block rather than per spectrum
+_CPU_ROWS_PER_BLOCK = 64
+
+# Scratch space on the GPU has to be sized at compile time. Requests for more points than this run on the CPU
+_CUDA_MAX_POINTS = 10
+_CUDA_MAX_PAIRS = _CUDA_MAX_POINTS * (_CUDA_MAX_POINTS - 1) // 2
+_CUDA_THREADS_PER_BLOCK = 256
+
+
+@vectorize(['float32(complex64)', 'float64(complex128)'], cache=True, fastmath=_FASTMATH_FLAGS)
+def _abs2(z):
+    """
+    Squared magnitude of complex values. Cheaper than abs(z) ** 2 since no square root is taken
+    """
+    return z.real * z.real + z.imag * z.imag
 
 
 def SHOfunc(parms, w_vec):
@@ -25,7 +59,7 @@ def SHOfunc(parms, w_vec):
         (w_vec ** 2 - 1j * w_vec * parms[1] / parms[2] - parms[1] ** 2)
 
 
-def SHOestimateGuess(resp_vec, w_vec, num_points=5):
+def SHOestimateGuess(resp_vec, w_vec, num_points=5, polish=False):
     """
     Generates good initial guesses for fitting
 
@@ -37,83 +71,522 @@ def SHOestimateGuess(resp_vec, w_vec, num_points=5):
         BE response vector as a function of frequency
     num_points : (Optional) unsigned int
         Quality factor of the SHO peak
+    polish : (Optional) bool
+        If the estimate fails, refine the coarse :func:`SHOfastGuess` with a few Levenberg-Marquardt iterations
+        instead of returning it as is. Default - False since this costs far more than the estimate itself
 
     Returns
     ---------
     retval : tuple
         SHO fit parameters arranged as amplitude, frequency, quality factor, phase
     """
+    w_vec = np.ascontiguousarray(w_vec, dtype=np.float64)
+    resp_vec = np.asarray(resp_vec)
+
+    resp_re, resp_im = _split_complex(resp_vec)
+    A_fit, w0_fit, Q_fit, phi_fit, success = _sho_guess_kernel(resp_re, resp_im, w_vec, num_points)
+    if success:
+        return np.array([A_fit, w0_fit, Q_fit, phi_fit])
+
+    guess = SHOfastGuess(w_vec, resp_vec)
+    if polish:
+        guess = _polish_guess(resp_vec, w_vec, guess)
+    return guess
+
+
+def SHOestimateGuessBatch(resp_mat, w_vec, num_points=5, out=None, polish=False):
+    """
+    Generates good initial guesses for fitting a stack of spectra. Equivalent to calling
+    :func:`SHOestimateGuess` on each row of `resp_mat` but the spectra are processed in parallel by compiled code,
+    on a CUDA GPU when one is available or otherwise across CPU threads.
+
+    Parameters
+    ------------
+    resp_mat : 2D complex numpy array
+        BE response vectors arranged as (spectra, frequency)
+    w_vec : 1D numpy array or list
+        Vector of BE frequencies
+    num_points : (Optional) unsigned int
+        Number of points with the largest amplitude that are used for the estimate
+    out : (Optional) 2D numpy array
+        Array of shape (spectra, 4) to write the guesses into, for example a slice of a larger results buffer.
+        May be of a lower precision such as float32. A new float64 array is allocated by default
+    polish : (Optional) bool
+        Refine the coarse guesses of spectra for which the estimate fails. See :func:`SHOestimateGuess`.
+        The refinement runs one spectrum at a time. Default - False
+
+    Returns
+    ---------
+    guess_mat : 2D numpy array
+        SHO fit parameters arranged as (spectra, [amplitude, frequency, quality factor, phase]). Same as `out` if
+        provided
+    """
+    w_vec = np.ascontiguousarray(w_vec, dtype=np.float64)
+    resp_mat = np.atleast_2d(resp_mat)
+
+    if out is None:
+        guess_mat = np.empty((resp_mat.shape[0], 4))
+    elif out.shape != (resp_mat.shape[0], 4):
+        raise ValueError('out should be of shape {} but was of shape {}'.format((resp_mat.shape[0], 4), out.shape))
+    else:
+        guess_mat = out
+    success = np.empty(resp_mat.shape[0], dtype=np.bool_)
+    resp_re, resp_im = _split_complex(resp_mat)
+    if num_points <= _CUDA_MAX_POINTS and cuda is not None and cuda.is_available():
+        _sho_guess_batch_cuda(resp_re, resp_im, w_vec, num_points, guess_mat, success)
+    else:
+        _sho_guess_batch(resp_re, resp_im, w_vec, num_points, guess_mat, success)
+
+    for spec_ind in np.where(~success)[0]:
+        guess = SHOfastGuess(w_vec, resp_mat[spec_ind])
+        if polish:
+            guess = _polish_guess(resp_mat[spec_ind], w_vec, guess)
+        guess_mat[spec_ind] = guess
+
+    return guess_mat
+
+
+def SHOrSquaredBatch(resp_mat, w_vec, guess_mat, out=None):
+    """
+    Coefficient of determination of the SHO model for each spectrum in a stack. The model response and both sums of
+    squares are accumulated in a single pass over each spectrum without creating temporary arrays.
+
+    Parameters
+    ------------
+    resp_mat : 2D complex numpy array
+        BE response vectors arranged as (spectra, frequency)
+    w_vec : 1D numpy array or list
+        Vector of BE frequencies
+    guess_mat : 2D numpy array
+        SHO parameters arranged as (spectra, [amplitude, frequency, quality factor, phase])
+    out : (Optional) 1D numpy array
+        Array of shape (spectra, ) to write R^2 into, for example a column of a larger results buffer.
+        A new float64 array is allocated by default
+
+    Returns
+    ---------
+    r_squared : 1D numpy array
+        R^2 of each spectrum. Set to 0 for spectra without any variance. Same as `out` if provided
+    """
+    w_vec = np.ascontiguousarray(w_vec, dtype=np.float64)
+    resp_re, resp_im = _split_complex(np.atleast_2d(resp_mat))
+    if out is None:
+        r_squared = np.empty(resp_re.shape[0])
+    elif out.shape != (resp_re.shape[0],):
+        raise ValueError('out should be of shape {} but was of shape {}'.format((resp_re.shape[0],), out.shape))
+    else:
+        r_squared = out
+    _sho_r_squared_batch(resp_re, resp_im, w_vec, np.asarray(guess_mat), r_squared)
+    return r_squared
+
+
+def _split_complex(resp):
+    """
+    Splits complex data into separate, contiguous, real and imaginary arrays so that compiled code reads two unit
+    stride streams instead of interleaved values. Single precision data stays in single precision.
+
+    Parameters
+    ------------
+    resp : complex numpy array
+        BE response
+
+    Returns
+    ---------
+    resp_re : float numpy array
+        Real component of the BE response
+    resp_im : float numpy array
+        Imaginary component of the BE response
+    """
+    dtype = np.float32 if resp.dtype == np.complex64 else np.float64
+    return np.ascontiguousarray(resp.real, dtype=dtype), np.ascontiguousarray(resp.imag, dtype=dtype)
+
+
+def _sho_residuals(parms, w_vec, resp_vec):
+    """
+    Real valued residuals between the SHO model and the BE response, stacked as [real, imaginary]
 
-    ii = np.argsort(abs(resp_vec))[::-1]
+    Parameters
+    -----------
+    parms : 1D numpy array
+        SHO parameters arranged as (A, w0, Q, phi)
+    w_vec : 1D numpy array
+        Vector of frequency values
+    resp_vec : 1D complex numpy array
+        BE response vector as a function of frequency
+
+    Returns
+    ---------
+    resid : 1D numpy array
+        Residuals of length 2 * len(w_vec)
+    """
+    diff = SHOfunc(parms, w_vec) - resp_vec
+    return np.concatenate((diff.real, diff.imag))
+
+
+def _sho_jacobian(parms, w_vec, resp_vec):
+    """
+    Analytic Jacobian of :func:`_sho_residuals` with respect to the SHO parameters
+
+    Parameters
+    -----------
+    parms : 1D numpy array
+        SHO parameters arranged as (A, w0, Q, phi)
+    w_vec : 1D numpy array
+        Vector of frequency values
+    resp_vec : 1D complex numpy array
+        BE response vector as a function of frequency. Unused since the residuals are linear in the response
+
+    Returns
+    ---------
+    jac : 2D numpy array
+        Jacobian of shape (2 * len(w_vec), 4)
+    """
+    amp, w_0, qual, phi = parms
+    denom = w_vec ** 2 - 1j * w_vec * w_0 / qual - w_0 ** 2
+    d_amp = exp(1j * phi) * w_0 ** 2 / denom
+    resp = amp * d_amp
+    d_w0 = resp * (2 / w_0 + (1j * w_vec / qual + 2 * w_0) / denom)
+    d_qual = -resp * (1j * w_vec * w_0 / qual ** 2) / denom
+    d_phi = 1j * resp
+    jac = np.column_stack((d_amp, d_w0, d_qual, d_phi))
+    return np.vstack((jac.real, jac.imag))
+
+
+def _polish_guess(resp_vec, w_vec, guess):
+    """
+    Refines a coarse SHO guess with a few Levenberg-Marquardt iterations using the analytic Jacobian.
+    The coarse guess is returned if the refined parameters are not physical or do not describe the response better.
+    The number of evaluations is capped since spectra that need this are often pure noise and would otherwise take
+    hundreds of iterations to get nowhere.
 
-    a_mat = np.array([])
-    e_vec = np.array([])
+    Parameters
+    ------------
+    resp_vec : 1D complex numpy array
+        BE response vector as a function of frequency
+    w_vec : 1D numpy array
+        Vector of BE frequencies
+    guess : 1D numpy array
+        Coarse SHO parameters arranged as [amplitude, frequency, quality factor, phase]
 
+    Returns
+    ---------
+    retval : 1D numpy array
+        SHO fit parameters arranged as [amplitude, frequency, quality factor, phase]
+    """
+    resp_vec = np.asarray(resp_vec, dtype=np.complex128)
+    with np.errstate(all='ignore'):
+        result = least_squares(_sho_residuals, guess, jac=_sho_jacobian, method='lm', x_scale='jac',
+                               max_nfev=_POLISH_MAX_NFEV, args=(w_vec, resp_vec))
+    amp, w_0, qual, phi = result.x
+    if not np.all(np.isfinite(result.x)) or qual <= 0 or not np.min(w_vec) <= w_0 <= np.max(w_vec):
+        return guess
+    if 2 * result.cost >= np.sum(np.abs(SHOfunc(guess, w_vec) - resp_vec) ** 2):
+        return guess
+
+    # A negative amplitude is the same response shifted by half a cycle
+    if amp < 0:
+        amp, phi = -amp, phi + np.pi
+    phi = np.angle(exp(1j * phi))
+    return np.array([amp, w_0, qual, phi])
+
+
+@njit(cache=True, parallel=True, nogil=True, fastmath=_FASTMATH_FLAGS, error_model='numpy')
+def _sho_guess_batch(resp_re, resp_im, w_vec, num_points, guess_mat, success):
+    """
+    Runs :func:`_sho_guess_core` over every spectrum (row) of the response, spreading blocks of rows across threads.
+    Results are written in place into `guess_mat` and `success`.
+    """
+    num_spectra = resp_re.shape[0]
+    num_points = max(0, min(num_points, w_vec.shape[0]))
+    num_blocks = (num_spectra + _CPU_ROWS_PER_BLOCK - 1) // _CPU_ROWS_PER_BLOCK
+    for block_ind in prange(num_blocks):
+        # Scratch space is reused by all spectra in the block
+        ii = np.empty(num_points, dtype=np.int64)
+        top_mat = np.empty((num_points, 4))
+        a_mat = np.empty((num_points * (num_points - 1) // 2, 5))
+        block_start = block_ind * _CPU_ROWS_PER_BLOCK
+        for spec_ind in range(block_start, min(num_spectra, block_start + _CPU_ROWS_PER_BLOCK)):
+            A_fit, w0_fit, Q_fit, phi_fit, ok = _sho_guess_core_cpu(resp_re[spec_ind], resp_im[spec_ind], w_vec,
+                                                                    num_points, ii, top_mat, a_mat)
+            guess_mat[spec_ind, 0] = A_fit
+            guess_mat[spec_ind, 1] = w0_fit
+            guess_mat[spec_ind, 2] = Q_fit
+            guess_mat[spec_ind, 3] = phi_fit
+            success[spec_ind] = ok
+
+
+@njit(cache=True, parallel=True, nogil=True, fastmath=_FASTMATH_FLAGS, error_model='numpy')
+def _sho_r_squared_batch(resp_re, resp_im, w_vec, guess_mat, r_squared):
+    """
+    Computes R^2 of :func:`SHOfunc` against each spectrum (row) of the response in place into `r_squared`.
+    The SHO response is evaluated in real arithmetic as A * w0^2 * exp(i phi) / (w^2 - w0^2 - i w w0 / Q)
+    """
+    num_freq = w_vec.size
+    for spec_ind in prange(resp_re.shape[0]):
+        amp = guess_mat[spec_ind, 0]
+        w_0 = guess_mat[spec_ind, 1]
+        qual = guess_mat[spec_ind, 2]
+        scale = amp * w_0 * w_0
+        cos_phi = math.cos(guess_mat[spec_ind, 3])
+        sin_phi = math.sin(guess_mat[spec_ind, 3])
+
+        mean_re = 0.0
+        mean_im = 0.0
+        for ind in range(num_freq):
+            mean_re += resp_re[spec_ind, ind]
+            mean_im += resp_im[spec_ind, ind]
+        mean_re /= num_freq
+        mean_im /= num_freq
+
+        ss_res = 0.0
+        ss_tot = 0.0
+        for ind in range(num_freq):
+            den_re = w_vec[ind] * w_vec[ind] - w_0 * w_0
+            den_im = -w_vec[ind] * w_0 / qual
+            fact = scale / (den_re * den_re + den_im * den_im)
+            fit_re = fact * (cos_phi * den_re + sin_phi * den_im)
+            fit_im = fact * (sin_phi * den_re - cos_phi * den_im)
+            val_re = resp_re[spec_ind, ind]
+            val_im = resp_im[spec_ind, ind]
+            ss_res += (val_re - fit_re) ** 2 + (val_im - fit_im) ** 2
+            ss_tot += (val_re - mean_re) ** 2 + (val_im - mean_im) ** 2
+
+        r_squared[spec_ind] = 1 - ss_res / ss_tot if ss_tot > 0 else 0.0
+
+
+def _sho_guess_core(resp_re, resp_im, w_vec, num_points, ii, top_mat, a_mat):
+    """
+    Core of :func:`SHOestimateGuess`. Each pair of the `num_points` strongest points of the response
+    yields an algebraic SHO estimate. The estimates are averaged with weights given by how well each one reproduces
+    the full response.
+
+    This is plain Python restricted to scalar math and indexing so that it can be compiled both for the CPU
+    (:func:`_sho_guess_kernel`) and as a CUDA device function. All scratch space is provided by the caller.
+
+    Parameters
+    ------------
+    resp_re : 1D float numpy array
+        Real component of the BE response
+    resp_im : 1D float numpy array
+        Imaginary component of the BE response
+    w_vec : 1D float numpy array
+        Vector of BE frequencies
+    num_points : unsigned int
+        Number of points with the largest amplitude that are used for the estimate
+    ii : 1D int numpy array
+        Scratch space with at least `num_points` elements
+    top_mat : 2D float numpy array
+        Scratch space of shape at least (num_points, 4)
+    a_mat : 2D float numpy array
+        Scratch space of shape at least (num_points * (num_points - 1) / 2, 5)
+
+    Returns
+    ---------
+    retval : tuple
+        Amplitude, frequency, quality factor, phase and whether or not the estimate can be trusted
+    """
+    num_freqs = w_vec.shape[0]
+    num_points = min(num_points, num_freqs)
+    if num_points < 2:
+        # No pairs of points to estimate from
+        return 0.0, 0.0, 0.0, 0.0, False
+
+    # Indices of the strongest points in descending order of amplitude found in a single pass, keeping a short
+    # sorted list of the best points so far (a partial sort, like np.argpartition, rather than a full argsort).
+    # Ties resolve to the later index, matching a reversed stable argsort.
+    # Single precision inputs are promoted on load so that all the arithmetic happens in double precision
+    num_found = 0
+    for t in range(num_freqs):
+        X1 = float(resp_re[t])
+        Y1 = float(resp_im[t])
+        power = X1 * X1 + Y1 * Y1
+        if num_found == num_points and power < top_mat[num_points - 1, 3]:
+            continue
+        pos = min(num_found, num_points - 1)
+        while pos > 0 and power >= top_mat[pos - 1, 3]:
+            ii[pos] = ii[pos - 1]
+            top_mat[pos, 3] = top_mat[pos - 1, 3]
+            pos -= 1
+        ii[pos] = t
+        top_mat[pos, 3] = power
+        num_found = min(num_found + 1, num_points)
+
+    # Gather the values at the strongest points once, ahead of the pairwise loop
+    for c1 in range(num_points):
+        top_mat[c1, 0] = w_vec[ii[c1]]
+        top_mat[c1, 1] = resp_re[ii[c1]]
+        top_mat[c1, 2] = resp_im[ii[c1]]
+
+    k = 0
     for c1 in range(num_points):
         for c2 in range(c1 + 1, num_points):
-            w1 = w_vec[ii[c1]]
-            w2 = w_vec[ii[c2]]
-            X1 = real(resp_vec[ii[c1]])
-            X2 = real(resp_vec[ii[c2]])
-            Y1 = imag(resp_vec[ii[c1]])
-            Y2 = imag(resp_vec[ii[c2]])
+            w1 = top_mat[c1, 0]
+            w2 = top_mat[c2, 0]
+            X1 = top_mat[c1, 1]
+            X2 = top_mat[c2, 1]
+            Y1 = top_mat[c1, 2]
+            Y2 = top_mat[c2, 2]
 
             denom = (w1 * (X1 ** 2 - X1 * X2 + Y1 * (Y1 - Y2)) + w2 * (-X1 * X2 + X2 ** 2 - Y1 * Y2 + Y2 ** 2))
-            if denom > 0:
-                a = ((w1 ** 2 - w2 ** 2) * (w1 * X2 * (X1 ** 2 + Y1 ** 2) - w2 * X1 * (X2 ** 2 + Y2 ** 2))) / denom
-                b = ((w1 ** 2 - w2 ** 2) * (w1 * Y2 * (X1 ** 2 + Y1 ** 2) - w2 * Y1 * (X2 ** 2 + Y2 ** 2))) / denom
-                c = ((w1 ** 2 - w2 ** 2) * (X2 * Y1 - X1 * Y2)) / denom
-                d = (w1 ** 3 * (X1 ** 2 + Y1 ** 2) -
-                     w1 ** 2 * w2 * (X1 * X2 + Y1 * Y2) -
-                     w1 * w2 ** 2 * (X1 * X2 + Y1 * Y2) +
-                     w2 ** 3 * (X2 ** 2 + Y2 ** 2)) / denom
-
-                if d > 0:
-                    a_mat = append(a_mat, [a, b, c, d])
-
-                    A_fit = abs(a + 1j * b) / d
-                    w0_fit = sqrt(d)
-                    Q_fit = -sqrt(d) / c
-                    phi_fit = arctan2(-b, -a)
-
-                    H_fit = A_fit * w0_fit ** 2 * exp(1j * phi_fit) / (
-                        w_vec ** 2 - 1j * w_vec * w0_fit / Q_fit - w0_fit ** 2)
-
-                    e_vec = append(e_vec,
-                                   sum((real(H_fit) - real(resp_vec)) ** 2) +
-                                   sum((imag(H_fit) - imag(resp_vec)) ** 2))
-    if a_mat.size > 0:
-        a_mat = a_mat.reshape(-1, 4)
-
-        weight_vec = (1 / e_vec) ** 4
-        w_sum = sum(weight_vec)
-
-        a_w = sum(weight_vec * a_mat[:, 0]) / w_sum
-        b_w = sum(weight_vec * a_mat[:, 1]) / w_sum
-        c_w = sum(weight_vec * a_mat[:, 2]) / w_sum
-        d_w = sum(weight_vec * a_mat[:, 3]) / w_sum
-
-        A_fit = abs(a_w + 1j * b_w) / d_w
-        w0_fit = sqrt(d_w)
-        Q_fit = -sqrt(d_w) / c_w
-        phi_fit = np.arctan2(-b_w, -a_w)
-
-        H_fit = A_fit * w0_fit ** 2 * exp(1j * phi_fit) / (w_vec ** 2 - 1j * w_vec * w0_fit / Q_fit - w0_fit ** 2)
-
-        if np.std(abs(resp_vec)) / np.std(abs(resp_vec - H_fit)) < 1.2 or w0_fit < np.min(w_vec) or w0_fit > np.max(
-                w_vec):
-            p0 = SHOfastGuess(w_vec, resp_vec)
-        else:
-            p0 = np.array([A_fit, w0_fit, Q_fit, phi_fit])
-    else:
-        p0 = SHOfastGuess(w_vec, resp_vec)
+            if denom <= 0:
+                continue
+
+            d = (w1 ** 3 * (X1 ** 2 + Y1 ** 2) -
+                 w1 ** 2 * w2 * (X1 * X2 + Y1 * Y2) -
+                 w1 * w2 ** 2 * (X1 * X2 + Y1 * Y2) +
+                 w2 ** 3 * (X2 ** 2 + Y2 ** 2)) / denom
+            if d <= 0:
+                continue
+
+            a = ((w1 ** 2 - w2 ** 2) * (w1 * X2 * (X1 ** 2 + Y1 ** 2) - w2 * X1 * (X2 ** 2 + Y2 ** 2))) / denom
+            b = ((w1 ** 2 - w2 ** 2) * (w1 * Y2 * (X1 ** 2 + Y1 ** 2) - w2 * Y1 * (X2 ** 2 + Y2 ** 2))) / denom
+            c = ((w1 ** 2 - w2 ** 2) * (X2 * Y1 - X1 * Y2)) / denom
+
+            A_fit = math.hypot(a, b) / d
+            w0_fit = math.sqrt(d)
+            Q_fit = -math.sqrt(d) / c
+            phi_fit = math.atan2(-b, -a)
+
+            # Evaluating H = num / (w ** 2 - 1j * w * damping - d), with d == w0_fit ** 2, in real arithmetic
+            num_re = A_fit * d * math.cos(phi_fit)
+            num_im = A_fit * d * math.sin(phi_fit)
+            damping = w0_fit / Q_fit
+            err = 0.0
+            for t in range(num_freqs):
+                den_re = w_vec[t] * w_vec[t] - d
+                den_im = -w_vec[t] * damping
+                den_sq = den_re * den_re + den_im * den_im
+                err_re = (num_re * den_re + num_im * den_im) / den_sq - resp_re[t]
+                err_im = (num_im * den_re - num_re * den_im) / den_sq - resp_im[t]
+                err += err_re * err_re + err_im * err_im
+
+            a_mat[k, 0] = a
+            a_mat[k, 1] = b
+            a_mat[k, 2] = c
+            a_mat[k, 3] = d
+            a_mat[k, 4] = err
+            k += 1
+
+    if k == 0:
+        return 0.0, 0.0, 0.0, 0.0, False
+
+    a_w = 0.0
+    b_w = 0.0
+    c_w = 0.0
+    d_w = 0.0
+    w_sum = 0.0
+    for c1 in range(k):
+        weight = (1 / a_mat[c1, 4]) ** 4
+        a_w += weight * a_mat[c1, 0]
+        b_w += weight * a_mat[c1, 1]
+        c_w += weight * a_mat[c1, 2]
+        d_w += weight * a_mat[c1, 3]
+        w_sum += weight
+    a_w /= w_sum
+    b_w /= w_sum
+    c_w /= w_sum
+    d_w /= w_sum
+
+    A_fit = math.hypot(a_w, b_w) / d_w
+    w0_fit = math.sqrt(d_w)
+    Q_fit = -math.sqrt(d_w) / c_w
+    phi_fit = math.atan2(-b_w, -a_w)
+
+    # Compare the spread of the response amplitude against that of the residual (ratio of standard deviations).
+    # Two passes over the spectrum in place of temporary arrays
+    num_re = A_fit * d_w * math.cos(phi_fit)
+    num_im = A_fit * d_w * math.sin(phi_fit)
+    damping = w0_fit / Q_fit
+    w_min = w_vec[0]
+    w_max = w_vec[0]
+    amp_mean = 0.0
+    res_mean = 0.0
+    for t in range(num_freqs):
+        w_min = min(w_min, w_vec[t])
+        w_max = max(w_max, w_vec[t])
+        den_re = w_vec[t] * w_vec[t] - d_w
+        den_im = -w_vec[t] * damping
+        den_sq = den_re * den_re + den_im * den_im
+        amp_mean += math.hypot(resp_re[t], resp_im[t])
+        res_mean += math.hypot(resp_re[t] - (num_re * den_re + num_im * den_im) / den_sq,
+                               resp_im[t] - (num_im * den_re - num_re * den_im) / den_sq)
+    amp_mean /= num_freqs
+    res_mean /= num_freqs
+
+    amp_var = 0.0
+    res_var = 0.0
+    for t in range(num_freqs):
+        den_re = w_vec[t] * w_vec[t] - d_w
+        den_im = -w_vec[t] * damping
+        den_sq = den_re * den_re + den_im * den_im
+        amp_var += (math.hypot(resp_re[t], resp_im[t]) - amp_mean) ** 2
+        res_var += (math.hypot(resp_re[t] - (num_re * den_re + num_im * den_im) / den_sq,
+                               resp_im[t] - (num_im * den_re - num_re * den_im) / den_sq) - res_mean) ** 2
+
+    success = not (math.sqrt(amp_var / res_var) < 1.2 or w0_fit < w_min or w0_fit > w_max)
+
+    return A_fit, w0_fit, Q_fit, phi_fit, success
+
+
+_sho_guess_core_cpu = njit(cache=True, nogil=True, fastmath=_FASTMATH_FLAGS, error_model='numpy')(_sho_guess_core)
+
+
+@njit(cache=True, nogil=True, fastmath=_FASTMATH_FLAGS, error_model='numpy')
+def _sho_guess_kernel(resp_re, resp_im, w_vec, num_points):
+    """
+    Compiled :func:`_sho_guess_core` for the CPU with freshly allocated scratch space.
+    See :func:`_sho_guess_core` for the parameters and returned values.
+    """
+    num_points = max(0, min(num_points, w_vec.shape[0]))
+    ii = np.empty(num_points, dtype=np.int64)
+    top_mat = np.empty((num_points, 4))
+    a_mat = np.empty((num_points * (num_points - 1) // 2, 5))
+    return _sho_guess_core_cpu(resp_re, resp_im, w_vec, num_points, ii, top_mat, a_mat)
 
-    return p0
+
+def _sho_guess_batch_cuda(resp_re, resp_im, w_vec, num_points, guess_mat, success):
+    """
+    Same as :func:`_sho_guess_batch` but on a CUDA GPU, with one thread per spectrum.
+    """
+    num_spectra = resp_re.shape[0]
+    if num_spectra == 0:
+        return
+    d_guess_mat = cuda.device_array(guess_mat.shape, dtype=guess_mat.dtype)
+    d_success = cuda.device_array(success.shape, dtype=success.dtype)
+    num_blocks = (num_spectra + _CUDA_THREADS_PER_BLOCK - 1) // _CUDA_THREADS_PER_BLOCK
+    _sho_guess_cuda[num_blocks, _CUDA_THREADS_PER_BLOCK](cuda.to_device(resp_re), cuda.to_device(resp_im),
+                                                         cuda.to_device(w_vec), num_points, d_guess_mat, d_success)
+    # guess_mat may be a strided view into a larger buffer, which cannot be the direct target of a device copy
+    guess_mat[:] = d_guess_mat.copy_to_host()
+    d_success.copy_to_host(success)
+
+
+if cuda is not None:
+    _sho_guess_core_cuda = cuda.jit(device=True)(_sho_guess_core)
+
+    @cuda.jit
+    def _sho_guess_cuda(resp_re, resp_im, w_vec, num_points, guess_mat, success):
+        """
+        CUDA kernel that runs :func:`_sho_guess_core` for the spectrum (row) matching the index of the thread
+        """
+        spec_ind = cuda.grid(1)
+        if spec_ind >= resp_re.shape[0]:
+            return
+        ii = cuda.local.array(_CUDA_MAX_POINTS, types.int64)
+        top_mat = cuda.local.array((_CUDA_MAX_POINTS, 4), types.float64)
+        a_mat = cuda.local.array((_CUDA_MAX_PAIRS, 5), types.float64)
+        A_fit, w0_fit, Q_fit, phi_fit, ok = _sho_guess_core_cuda(resp_re[spec_ind], resp_im[spec_ind], w_vec,
+                                                                 num_points, ii, top_mat, a_mat)
+        guess_mat[spec_ind, 0] = A_fit
+        guess_mat[spec_ind, 1] = w0_fit
+        guess_mat[spec_ind, 2] = Q_fit
+        guess_mat[spec_ind, 3] = phi_fit
+        success[spec_ind] = ok
 
 
 def SHOfastGuess(w_vec, resp_vec, qual_factor=200):
     """
-    Default SHO guess from the maximum value of the response
+    Default SHO guess from the center of the band. The amplitude is scaled from the root mean square of the response
 
     Parameters
     ------------
@@ -129,9 +602,11 @@ def SHOfastGuess(w_vec, resp_vec, qual_factor=200):
     retval : 1D numpy array
         SHO fit parameters arranged as [amplitude, frequency, quality factor, phase]
     """
-    amp_vec = abs(resp_vec)
+    resp_vec = np.asarray(resp_vec)
+    power_vec = _abs2(resp_vec.astype(np.result_type(resp_vec, np.complex64), copy=False))
     i_max = int(len(resp_vec) / 2)
-    return np.array([np.mean(amp_vec) / qual_factor, w_vec[i_max], qual_factor, np.angle(resp_vec[i_max])])
+    return np.array([np.sqrt(np.mean(power_vec)) / qual_factor, w_vec[i_max], qual_factor,
+                     np.angle(resp_vec[i_max])])
 
 
 def SHOlowerBound(w_vec):
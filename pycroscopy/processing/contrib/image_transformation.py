@@ -22,10 +22,10 @@ def pickle_keypoints(keypoints):
     """
     Function to pickle cv2.sift keypoint objects
     """
-    kpArray = np.array([])
-    for point in keypoints:
-        kpArray = np.append(kpArray, [point.pt[1], point.pt[0]])
-    kpArray = np.reshape(kpArray, (int(kpArray.size / 2), 2))
+    kpArray = np.empty((len(keypoints), 2))
+    for ind, point in enumerate(keypoints):
+        kpArray[ind, 0] = point.pt[1]
+        kpArray[ind, 1] = point.pt[0]
     return kpArray
 
 
@@ -137,7 +137,7 @@ def verlet(zb, Fo1, Fo2, Fo3, Q1, Q2, Q3, k_L1, k_L2, k_L3, time, z1, z2,z3, v1,
     tip = z1 + z2 + z3 + zb
     return tip, z1, z2, z3, v1, v2, v3, z1_old, z2_old, z3_old
 
-numba_verlet = jit()(verlet) #it is important to keep this line out of the effectively accelerate the function when called
+numba_verlet = jit(cache=True)(verlet) #it is important to keep this line out of the effectively accelerate the function when called
 
 def gen_maxwell_lr(G, tau, R, dt, startprint, simultime, fo1, fo2, fo3, k_m1, k_m2, k_m3, A1, A2, A3, zb, printstep = 1, Ge = 0.0, Q1=100, Q2=200, Q3=300, H=2.0e-19):
     """This function is designed for multifrequency simulation performed over a Generalized Maxwell (Wiechert) viscoelastic surface.
@@ -310,7 +310,7 @@ def gen_maxwell_lr(G, tau, R, dt, startprint, simultime, fo1, fo2, fo3, k_m1, k_
     return np.array(t_a), np.array(tip_a), np.array(Fts_a), np.array(xb_a)
 
 
-GenMaxwell_jit = jit()(gen_maxwell_lr)  #this line should stay outside function to allow the numba compilation and simulation acceleration work properly
+GenMaxwell_jit = jit(cache=True)(gen_maxwell_lr)  #this line should stay outside function to allow the numba compilation and simulation acceleration work properly
 
 def dynamic_spectroscopy(G, tau, R, dt, startprint, simultime, fo1, fo2, fo3, k_m1, k_m2, k_m3, A1, A2, A3, printstep = 1, Ge = 0.0, Q1=100, Q2=200, Q3=300, H=2.0e-19, z_step = 1):
     """This function is designed for tapping mode spectroscopy to obtain amplitude and phase curves as the cantilever is approached towards the surface.
@@ -539,7 +539,7 @@ def verlet_FS(y_t, Q1, Q2, Q3, k1, k2, k3, time, z1, z2,z3, v1,v2,v3, z1_old, z2
     tip = z1 + z2 + z3
     return tip, z1, z2, z3, v1, v2, v3, z1_old, z2_old, z3_old
 
-numba_verlet_FS = jit()(verlet_FS)    
+numba_verlet_FS = jit(cache=True)(verlet_FS)
 
 def sfs_genmaxwell_lr(G, tau, R, dt, simultime, y_dot, y_t_initial, k_m1, fo1, Ge = 0.0, Q1=100, printstep = 1, H = 2.0e-19, Q2=200, Q3=300, startprint = 1, vdw = 1):
     """This function is designed for force spectroscopy over a Generalized Maxwel surface
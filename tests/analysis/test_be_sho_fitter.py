@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for pycroscopy.analysis.be_sho_fitter
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+import sys
+import os
+import unittest
+import numpy as np
+import h5py
+from pyUSID import Dimension
+from pyUSID.io.hdf_utils import write_main_dataset
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.analysis import be_sho_fitter
+from pycroscopy.analysis.be_sho_fitter import BESHOfitter
+from pycroscopy.analysis.utils.be_sho import SHOfunc
+
+test_h5_file_path = 'temp_be_sho_fitter.h5'
+
+num_pos = 40
+num_steps = 3
+w_vec = np.linspace(300E+3, 320E+3, 87)
+
+
+def write_be_dataset(h5_f):
+    """
+    Writes a BE dataset with one SHO response per position and DC step
+    """
+    rng = np.random.RandomState(0)
+    parms = np.vstack((rng.uniform(1E-4, 1E-3, num_pos * num_steps),
+                       rng.uniform(303E+3, 317E+3, num_pos * num_steps),
+                       rng.uniform(50, 300, num_pos * num_steps),
+                       rng.uniform(-np.pi, np.pi, num_pos * num_steps))).T
+    resp_mat = np.array([SHOfunc(sho_parms, w_vec) for sho_parms in parms], dtype=np.complex64)
+    h5_grp = h5_f.create_group('Measurement_000/Channel_000')
+    return write_main_dataset(h5_grp, resp_mat.reshape(num_pos, -1), 'Raw_Data', 'Piezoresponse', 'V',
+                              [Dimension('X', 'm', num_pos)],
+                              [Dimension('Frequency', 'Hz', w_vec), Dimension('DC_Offset', 'V', num_steps)])
+
+
+class TestBESHOfitter(unittest.TestCase):
+
+    def setUp(self):
+        self.h5_f = h5py.File(test_h5_file_path, mode='w')
+        self.h5_main = write_be_dataset(self.h5_f)
+        self.fitter = BESHOfitter(self.h5_main)
+
+    def tearDown(self):
+        self.h5_f.close()
+        if os.path.exists(test_h5_file_path):
+            os.remove(test_h5_file_path)
+
+    @unittest.skipIf(be_sho_fitter.set_num_threads is None, 'numba too old to set the number of threads')
+    def test_compute_guess_restores_num_threads(self):
+        orig_num_threads = be_sho_fitter.get_num_threads()
+        self.fitter._get_data_chunk()
+        guess = self.fitter._compute_guess(1, 'complex_gaussian', {'frequencies': self.fitter.freq_vec})
+        self.assertEqual(guess.shape, (num_pos * num_steps, 5))
+        self.assertEqual(be_sho_fitter.get_num_threads(), orig_num_threads)
+
+    def test_guess_chunks(self):
+        self.fitter._create_guess_datasets()
+        chunks = self.fitter.h5_guess.chunks
+        # The whole Guess is far below the ~1 MB per chunk target so it fits in one chunk
+        self.assertEqual(chunks, (num_pos, num_steps))
+        self.assertLessEqual(chunks[0] * chunks[1] * self.fitter.h5_guess.dtype.itemsize, 1 << 20)
+
+    def test_guess_reads_aligned_to_chunks(self):
+        # Reading more positions than one chunk holds is trimmed to whole chunks
+        self.fitter._max_pos_per_read = num_pos + 7
+        h5_guess = self.fitter.do_guess(options={'num_points': 5})
+        self.assertEqual(self.fitter._max_pos_per_read, num_pos)
+        self.assertEqual(h5_guess.attrs['last_pixel'], num_pos)
+
+    def test_guess_reads_smaller_than_chunk(self):
+        # Reading fewer positions than one chunk holds is left alone and still fills the whole Guess
+        self.fitter._max_pos_per_read = 7
+        h5_guess = self.fitter.do_guess(options={'num_points': 5})
+        self.assertEqual(self.fitter._max_pos_per_read, 7)
+        self.assertEqual(h5_guess.attrs['last_pixel'], num_pos)
+        self.assertTrue(np.all(h5_guess['Frequency [Hz]'] > 0))
+
+    def test_compact_guess_fit(self):
+        h5_guess = self.fitter.do_guess(options={'num_points': 5}, compact_guess=True)
+        self.assertEqual(h5_guess.dtype, be_sho_fitter.sho_compact)
+
+        h5_fit = self.fitter.do_fit()
+        self.assertEqual(h5_fit.dtype, be_sho_fitter.sho32)
+        self.assertEqual(h5_fit.shape, h5_guess.shape)
+        self.assertEqual(h5_fit.attrs['last_pixel'], num_pos)
+        self.assertTrue(np.allclose(h5_fit['Frequency [Hz]'], h5_guess['Frequency [Hz]'], rtol=1E-3))
+
+    def test_old_guess_matches_dtype(self):
+        h5_full = self.fitter.do_guess(options={'num_points': 5})
+        self.assertEqual(h5_full.dtype, be_sho_fitter.sho32)
+
+        # A compact Guess is computed afresh rather than returning the full precision one, and vice versa
+        fitter = BESHOfitter(self.h5_main)
+        h5_compact = fitter.do_guess(options={'num_points': 5}, compact_guess=True)
+        self.assertEqual(h5_compact.dtype, be_sho_fitter.sho_compact)
+        self.assertNotEqual(h5_compact.name, h5_full.name)
+
+        fitter = BESHOfitter(self.h5_main)
+        self.assertEqual(fitter.do_guess(options={'num_points': 5}).name, h5_full.name)
+        fitter = BESHOfitter(self.h5_main)
+        self.assertEqual(fitter.do_guess(options={'num_points': 5}, compact_guess=True).name, h5_compact.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,13 +8,107 @@ import unittest
 import numpy as np
 import h5py
 from pyUSID import USIDataset, Dimension
-from pyUSID.io.hdf_utils import write_simple_attrs, write_main_dataset
+from pyUSID.io.hdf_utils import write_simple_attrs, write_main_dataset, create_results_group
 sys.path.append("../../../pycroscopy/")
 from pycroscopy.analysis.fitter import Fitter
 
 test_h5_file_path = 'temp_base_fitter.h5'
 
 
+class StubComm(object):
+    """
+    Stands in for an mpi4py communicator when only the rank and size are needed
+    """
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+
+class StubDatasetID(object):
+    """
+    Records low-level writes to a StubCollectiveDataset as the number of points selected in memory and on file
+    """
+    def __init__(self, dset, shape):
+        self._dset = dset
+        self._shape = shape
+
+    def get_space(self):
+        return h5py.h5s.create_simple(self._shape)
+
+    def write(self, mem_space, file_space, arr, dxpl=None):
+        self._dset.low_level_writes.append((mem_space.get_select_npoints(), file_space.get_select_npoints(),
+                                            self._dset._in_collective))
+
+
+class StubCollectiveDataset(object):
+    """
+    Records writes and whether they were made within a collective context, since h5py built without MPI has no
+    Dataset.collective
+    """
+    def __init__(self, shape=(8, 3), dtype=np.float64):
+        self.attrs = dict()
+        self.dtype = np.dtype(dtype)
+        self.id = StubDatasetID(self, shape)
+        self._dxpl = None
+        self.writes = []
+        self.low_level_writes = []
+        self._in_collective = False
+
+    @property
+    def collective(self):
+        return self
+
+    def __enter__(self):
+        self._in_collective = True
+
+    def __exit__(self, *args):
+        self._in_collective = False
+
+    def __setitem__(self, key, value):
+        self.writes.append((key, np.array(value), self._in_collective))
+
+
+class MaxFitter(Fitter):
+    """
+    Minimal Fitter whose guess is the maximum of each cycle. Used to exercise the chunked guess loop
+    """
+    def __init__(self, *args, **kwargs):
+        super(MaxFitter, self).__init__(*args, **kwargs)
+        self._fitter_name = 'Max_Fitter'
+
+    def _create_guess_datasets(self):
+        h5_group = create_results_group(self.h5_main, self._fitter_name)
+        self.h5_guess = write_main_dataset(h5_group, (self.h5_main.shape[0], 2), 'Guess', 'Guess', 'a.u.',
+                                           None, Dimension('Cycle', 'a.u.', 2), dtype=np.float32,
+                                           h5_pos_inds=self.h5_main.h5_pos_inds,
+                                           h5_pos_vals=self.h5_main.h5_pos_vals, chunks=(2, 2))
+        write_simple_attrs(self.h5_guess, {'last_pixel': 0})
+
+    def _create_fit_datasets(self):
+        h5_guess = USIDataset(self.h5_guess)
+        self.h5_fit = write_main_dataset(h5_guess.parent, h5_guess.shape, 'Fit', 'Fit', 'a.u.', None, None,
+                                         dtype=np.float32, h5_pos_inds=h5_guess.h5_pos_inds,
+                                         h5_pos_vals=h5_guess.h5_pos_vals, h5_spec_inds=h5_guess.h5_spec_inds,
+                                         h5_spec_vals=h5_guess.h5_spec_vals, chunks=(2, 2))
+        write_simple_attrs(self.h5_fit, {'last_pixel': 0})
+
+    def _compute_guess(self, processors, strategy, options):
+        return self.data.reshape(self.data.shape[0], 2, -1).max(axis=2)
+
+    def _set_results(self, is_guess=False):
+        if is_guess:
+            self.guess = self.guess.reshape(-1, 2)
+        else:
+            self.fit = self.fit.reshape(-1, 2)
+        super(MaxFitter, self)._set_results(is_guess)
+
+
 class TestBaseFitterClass(unittest.TestCase):
     """
     Test class for the base Fitter class
@@ -121,6 +215,118 @@ class TestBaseFitterClass(unittest.TestCase):
         self.assertTrue(np.array_equal(np.array([], dtype=np.float64).reshape([0, 2]),
                                        self.fitter.guess))
 
+    def test_align_reads_to_chunks(self):
+        h5_dset = self.h5_f.create_dataset('chunked', shape=(15, 2), chunks=(4, 2))
+        # More positions per read than rows per chunk - trimmed to a whole number of chunks
+        self.fitter._max_pos_per_read = 10
+        self.fitter._align_reads_to_chunks(h5_dset)
+        self.assertEqual(self.fitter._max_pos_per_read, 8)
+        self.assertEqual(self.fitter._rows_per_chunk, 4)
+
+        # Already a whole number of chunks
+        self.fitter._align_reads_to_chunks(h5_dset)
+        self.assertEqual(self.fitter._max_pos_per_read, 8)
+
+        # Fewer positions per read than rows per chunk - left alone rather than trimmed to nothing
+        self.fitter._max_pos_per_read = 3
+        self.fitter._align_reads_to_chunks(h5_dset)
+        self.assertEqual(self.fitter._max_pos_per_read, 3)
+
+    def test_align_reads_contiguous_dataset(self):
+        h5_dset = self.h5_f.create_dataset('contiguous', shape=(15, 2))
+        self.fitter._max_pos_per_read = 10
+        self.fitter._align_reads_to_chunks(h5_dset)
+        self.assertEqual(self.fitter._max_pos_per_read, 10)
+
+    def test_rank_bounds_no_comm(self):
+        self.fitter._start_pos = 3
+        self.fitter._end_pos = 13
+        self.assertEqual(self.fitter._get_rank_bounds(), (3, 13))
+
+    def test_rank_bounds_cover_chunk(self):
+        self.fitter._start_pos = 3
+        self.fitter._end_pos = 13
+        for size in range(1, 14):
+            bounds = []
+            for rank in range(size):
+                self.fitter._comm = StubComm(rank, size)
+                bounds.append(self.fitter._get_rank_bounds())
+            # Ranks own consecutive, non-overlapping ranges that together make up the chunk
+            self.assertEqual(bounds[0][0], 3)
+            self.assertEqual(bounds[-1][1], 13)
+            for (_, prev_end), (start, end) in zip(bounds[:-1], bounds[1:]):
+                self.assertEqual(start, prev_end)
+            num_rows = [end - start for start, end in bounds]
+            self.assertLessEqual(max(num_rows) - min(num_rows), 1)
+            if size > 10:
+                self.assertIn(0, num_rows)
+
+    def test_rank_bounds_aligned_to_chunks(self):
+        self.fitter._rows_per_chunk = 4
+        for chunk_start, chunk_end in [(0, 8), (8, 15), (3, 13)]:
+            self.fitter._start_pos = chunk_start
+            self.fitter._end_pos = chunk_end
+            for size in range(1, 6):
+                bounds = []
+                for rank in range(size):
+                    self.fitter._comm = StubComm(rank, size)
+                    bounds.append(self.fitter._get_rank_bounds())
+                self.assertEqual(bounds[0][0], chunk_start)
+                self.assertEqual(bounds[-1][1], chunk_end)
+                for (_, prev_end), (start, end) in zip(bounds[:-1], bounds[1:]):
+                    self.assertEqual(start, prev_end)
+                # Ranks only ever split the chunk of positions at HDF5 chunk boundaries
+                for start, end in bounds:
+                    self.assertTrue(end % 4 == 0 or end in (start, chunk_end))
+
+    def test_get_data_chunk_with_comm(self):
+        self.fitter._start_pos = 0
+        self.fitter._max_pos_per_read = 10
+        self.fitter._comm = StubComm(1, 3)
+        self.fitter._get_data_chunk()
+
+        self.assertEqual(self.fitter._end_pos, 10)
+        self.assertTrue(np.array_equal(self.fitter.data, self.h5_main[3:6, :]))
+
+    def test_get_data_chunk_rank_without_rows(self):
+        self.fitter._start_pos = self.h5_main.shape[0] - 2
+        self.fitter._comm = StubComm(0, 4)
+        self.fitter._get_data_chunk()
+
+        self.assertEqual(self.fitter.data.shape, (0, self.h5_main.shape[1]))
+
+    def test_get_guess_chunk_with_comm(self):
+        self.fitter.h5_guess = self.h5_guess
+        self.fitter._start_pos = 0
+        self.fitter._max_pos_per_read = 10
+        self.fitter._comm = StubComm(2, 3)
+        self.fitter._get_guess_chunk()
+
+        self.assertTrue(np.array_equal(self.fitter.guess, self.h5_guess[6:10, :]))
+
+    def test_write_chunk_with_comm(self):
+        targ_dset = StubCollectiveDataset()
+        self.fitter._comm = StubComm(1, 2)
+        self.fitter._write_chunk(targ_dset, np.ones((2, 3)), 4, 6, 8, 'guess')
+
+        self.assertEqual(len(targ_dset.writes), 1)
+        key, value, in_collective = targ_dset.writes[0]
+        self.assertEqual(key, (slice(4, 6), slice(None)))
+        self.assertTrue(np.array_equal(value, np.ones((2, 3))))
+        self.assertTrue(in_collective)
+        self.assertEqual(targ_dset.low_level_writes, [])
+        self.assertEqual(targ_dset.attrs['last_pixel'], 8)
+
+    def test_write_chunk_rank_without_rows(self):
+        # The rank must still take part in the collective write even though it has nothing to write
+        targ_dset = StubCollectiveDataset()
+        self.fitter._comm = StubComm(0, 4)
+        self.fitter._write_chunk(targ_dset, np.ones((0, 3)), 6, 6, 8, 'guess')
+
+        self.assertEqual(targ_dset.writes, [])
+        self.assertEqual(targ_dset.low_level_writes, [(0, 0, True)])
+        self.assertEqual(targ_dset.attrs['last_pixel'], 8)
+
     def test_check_for_old_guess_no_last_pixel(self):
         self.fitter._fitter_name = 'Fitter'
         self.fitter._parms_dict = dict()
@@ -183,5 +389,89 @@ class TestBaseFitterClass(unittest.TestCase):
             self.fitter.do_guess(strategy=strategy)
 
 
+class TestBackgroundWrites(unittest.TestCase):
+    """
+    Tests for the guess loop writing results to file while the next chunk is computed
+    """
+    def setUp(self):
+        self.h5_f = h5py.File(test_h5_file_path, mode='w')
+        h5_raw_grp = self.h5_f.create_group('Raw_Measurement')
+        self.num_pos = 15
+        self.source_main_data = np.random.rand(self.num_pos, 14)
+        self.h5_main = write_main_dataset(h5_raw_grp, self.source_main_data, 'source_main', 'Current', 'A',
+                                          Dimension('X', 'nm', self.num_pos),
+                                          [Dimension('Bias', 'V', 7), Dimension('Cycle', 'a.u.', 2)])
+        self.fitter = MaxFitter(self.h5_main, variables=['Bias'], parallel=False)
+        # Reading 4 positions at a time makes the 15 positions span 4 chunks
+        self.fitter._max_pos_per_read = 4
+        self.expected = self.source_main_data.reshape(self.num_pos, 2, 7).max(axis=2)
+
+    def tearDown(self):
+        self.h5_f.close()
+        if os.path.exists(test_h5_file_path):
+            os.remove(test_h5_file_path)
+
+    def test_multi_chunk_guess_complete(self):
+        h5_guess = self.fitter.do_guess(strategy='absolute_maximum')
+        self.assertTrue(np.allclose(h5_guess[()], self.expected))
+        self.assertEqual(h5_guess.attrs['last_pixel'], self.num_pos)
+        self.assertIsNone(self.fitter._write_executor)
+
+    def test_write_error_raised(self):
+        def failing_write(*args):
+            raise IOError('Disk full')
+
+        self.fitter._write_chunk = failing_write
+        with self.assertRaises(IOError):
+            self.fitter.do_guess(strategy='absolute_maximum')
+        self.assertIsNone(self.fitter._write_executor)
+
+    def test_aborted_guess_joins_writes(self):
+        compute_guess = self.fitter._compute_guess
+
+        def interrupted_compute(processors, strategy, options):
+            if self.fitter._start_pos > 0:
+                raise KeyboardInterrupt
+            return compute_guess(processors, strategy, options)
+
+        self.fitter._compute_guess = interrupted_compute
+        with self.assertRaises(KeyboardInterrupt):
+            self.fitter.do_guess(strategy='absolute_maximum')
+
+        # The first chunk must be on file and marked complete so that the computation can be resumed
+        self.assertIsNone(self.fitter._write_executor)
+        self.assertEqual(self.fitter.h5_guess.attrs['last_pixel'], 4)
+        self.assertTrue(np.allclose(self.fitter.h5_guess[:4], self.expected[:4]))
+
+    def test_rank_without_rows(self):
+        h5_guess = self.fitter.do_guess(strategy='absolute_maximum')
+        writes = []
+
+        def record_write(targ_dset, source_dset, start, end, last_pixel, statement):
+            writes.append((statement, source_dset.shape, start, end, last_pixel))
+
+        def no_compute(*args, **kwargs):
+            raise AssertionError('A rank without positions should not compute anything')
+
+        def rank_without_rows():
+            # With 8 ranks sharing chunks of at most 4 positions, rank 0 never owns any positions
+            fitter = MaxFitter(self.h5_main, variables=['Bias'], parallel=False, verbose=True)
+            fitter._comm = StubComm(0, 8)
+            fitter._max_pos_per_read = 4
+            fitter._write_chunk = record_write
+            fitter._compute_guess = no_compute
+            return fitter
+
+        rank_without_rows().do_guess(strategy='absolute_maximum', override=True)
+        rank_without_rows().do_fit(solver_options={}, obj_func={'obj_func': 'SHO'}, h5_guess=h5_guess)
+
+        # Every chunk is still written, with no rows, and marked complete just as the other ranks do
+        for statement in ['guess', 'fit']:
+            chunk_writes = [write[1:] for write in writes if write[0] == statement]
+            self.assertEqual([shape for shape, _, _, _ in chunk_writes], [(0, 2)] * 4)
+            self.assertTrue(all(start == end for _, start, end, _ in chunk_writes))
+            self.assertEqual([last_pixel for _, _, _, last_pixel in chunk_writes], [4, 8, 12, 15])
+
+
 if __name__ == '__main__':
     unittest.main()
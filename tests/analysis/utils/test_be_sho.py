@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the SHO guess functions in pycroscopy.analysis.utils.be_sho
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import numpy as np
+import sys
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.analysis.utils import be_sho
+from pycroscopy.analysis.utils.be_sho import SHOfunc, SHOestimateGuess, SHOestimateGuessBatch, SHOfastGuess, \
+    SHOrSquaredBatch, _sho_residuals, _sho_jacobian
+
+w_vec = np.linspace(300E+3, 320E+3, 87)
+
+
+def make_spectra(num_spectra, noise=0.05, seed=0):
+    rng = np.random.RandomState(seed)
+    parms = np.vstack((rng.uniform(1E-4, 1E-3, num_spectra),
+                       rng.uniform(303E+3, 317E+3, num_spectra),
+                       rng.uniform(50, 300, num_spectra),
+                       rng.uniform(-np.pi, np.pi, num_spectra))).T
+    resp_mat = np.array([SHOfunc(sho_parms, w_vec) for sho_parms in parms])
+    resp_mat += noise * parms[:, :1] * (rng.randn(*resp_mat.shape) + 1j * rng.randn(*resp_mat.shape))
+    return parms, resp_mat
+
+
+class TestSHOEstimateGuess(unittest.TestCase):
+
+    def test_clean_spectrum_recovered(self):
+        parms, resp_mat = make_spectra(1, noise=0)
+        guess = SHOestimateGuess(resp_mat[0], w_vec)
+        self.assertTrue(np.allclose(guess, parms[0], rtol=1E-3))
+
+    def test_list_inputs(self):
+        _, resp_mat = make_spectra(1)
+        guess = SHOestimateGuess(list(resp_mat[0]), list(w_vec))
+        self.assertTrue(np.allclose(guess, SHOestimateGuess(resp_mat[0], w_vec)))
+
+    def test_pure_noise_falls_back(self):
+        rng = np.random.RandomState(2)
+        resp_vec = 1E-4 * (rng.randn(w_vec.size) + 1j * rng.randn(w_vec.size))
+        guess = SHOestimateGuess(resp_vec, w_vec)
+        self.assertTrue(np.allclose(guess, SHOfastGuess(w_vec, resp_vec)))
+
+    def test_pure_noise_polished(self):
+        rng = np.random.RandomState(2)
+        resp_vec = 1E-4 * (rng.randn(w_vec.size) + 1j * rng.randn(w_vec.size))
+        guess = SHOestimateGuess(resp_vec, w_vec, polish=True)
+        fast_guess = SHOfastGuess(w_vec, resp_vec)
+        # The fallback may only be refined if that describes the response better
+        self.assertLessEqual(np.sum(np.abs(SHOfunc(guess, w_vec) - resp_vec) ** 2),
+                             np.sum(np.abs(SHOfunc(fast_guess, w_vec) - resp_vec) ** 2))
+        self.assertTrue(np.min(w_vec) <= guess[1] <= np.max(w_vec))
+        self.assertGreater(guess[2], 0)
+
+    def test_jacobian_matches_finite_differences(self):
+        parms, resp_mat = make_spectra(1)
+        jac = _sho_jacobian(parms[0], w_vec, resp_mat[0])
+        self.assertEqual(jac.shape, (2 * w_vec.size, 4))
+        for col in range(4):
+            step = np.zeros(4)
+            step[col] = 1E-6 * abs(parms[0, col])
+            fin_diff = (_sho_residuals(parms[0] + step, w_vec, resp_mat[0]) -
+                        _sho_residuals(parms[0] - step, w_vec, resp_mat[0])) / (2 * step[col])
+            self.assertTrue(np.allclose(jac[:, col], fin_diff, rtol=1E-4, atol=1E-4 * np.max(np.abs(fin_diff))))
+
+
+class TestSHOEstimateGuessBatch(unittest.TestCase):
+
+    def test_matches_single_spectrum(self):
+        # Enough spectra to span several blocks of rows, the last of which is partial
+        num_spectra = 2 * be_sho._CPU_ROWS_PER_BLOCK + 22
+        _, resp_mat = make_spectra(num_spectra, noise=0.5)
+        expected = np.array([SHOestimateGuess(resp_vec, w_vec) for resp_vec in resp_mat])
+        guess_mat = SHOestimateGuessBatch(resp_mat, w_vec)
+        self.assertEqual(guess_mat.shape, (num_spectra, 4))
+        self.assertTrue(np.allclose(guess_mat, expected))
+
+    def test_pure_noise_falls_back(self):
+        rng = np.random.RandomState(3)
+        resp_mat = 1E-4 * (rng.randn(20, w_vec.size) + 1j * rng.randn(20, w_vec.size))
+        guess_mat = SHOestimateGuessBatch(resp_mat, w_vec)
+        expected = np.array([SHOfastGuess(w_vec, resp_vec) for resp_vec in resp_mat])
+        self.assertTrue(np.allclose(guess_mat, expected))
+
+    def test_polish_is_capped(self):
+        rng = np.random.RandomState(3)
+        resp_mat = 1E-4 * (rng.randn(20, w_vec.size) + 1j * rng.randn(20, w_vec.size))
+        num_calls = [0]
+        residuals = be_sho._sho_residuals
+
+        def counting_residuals(*args):
+            num_calls[0] += 1
+            return residuals(*args)
+
+        be_sho._sho_residuals = counting_residuals
+        try:
+            guess_mat = SHOestimateGuessBatch(resp_mat, w_vec, polish=True)
+        finally:
+            be_sho._sho_residuals = residuals
+
+        # least_squares evaluates the starting point once up front and MINPACK only checks the cap between iterations
+        self.assertLessEqual(num_calls[0], resp_mat.shape[0] * (be_sho._POLISH_MAX_NFEV + 2))
+        for resp_vec, guess in zip(resp_mat, guess_mat):
+            fast_guess = SHOfastGuess(w_vec, resp_vec)
+            self.assertLessEqual(np.sum(np.abs(SHOfunc(guess, w_vec) - resp_vec) ** 2),
+                                 np.sum(np.abs(SHOfunc(fast_guess, w_vec) - resp_vec) ** 2))
+
+    def test_complex64_input(self):
+        _, resp_mat = make_spectra(10)
+        guess_mat = SHOestimateGuessBatch(resp_mat.astype(np.complex64), w_vec)
+        self.assertTrue(np.allclose(guess_mat, SHOestimateGuessBatch(resp_mat, w_vec), rtol=1E-3))
+
+    def test_out_strided_float32(self):
+        _, resp_mat = make_spectra(10)
+        results = np.full((10, 5), -1, dtype=np.float32)
+        guess_mat = SHOestimateGuessBatch(resp_mat, w_vec, out=results[:, :4])
+        self.assertTrue(np.shares_memory(guess_mat, results))
+        self.assertTrue(np.allclose(results[:, :4], SHOestimateGuessBatch(resp_mat, w_vec), rtol=1E-6))
+        # The column that was not part of out is left untouched
+        self.assertTrue(np.all(results[:, 4] == -1))
+
+    def test_out_wrong_shape(self):
+        _, resp_mat = make_spectra(10)
+        with self.assertRaises(ValueError):
+            SHOestimateGuessBatch(resp_mat, w_vec, out=np.empty((10, 5)))
+        with self.assertRaises(ValueError):
+            SHOestimateGuessBatch(resp_mat, w_vec, out=np.empty((9, 4)))
+
+
+@unittest.skipIf(be_sho.cuda is None or not be_sho.cuda.is_available(),
+                 'No CUDA GPU. Set NUMBA_ENABLE_CUDASIM=1 to run on the CUDA simulator instead')
+class TestSHOEstimateGuessBatchCUDA(unittest.TestCase):
+
+    def test_matches_cpu_kernel(self):
+        _, resp_mat = make_spectra(12, noise=0.5)
+        resp_mat[-2:] = 1E-4 * np.random.RandomState(4).randn(2, w_vec.size)
+        resp_re, resp_im = be_sho._split_complex(resp_mat)
+        cpu_guess, cpu_success = np.empty((12, 4)), np.empty(12, dtype=np.bool_)
+        gpu_guess, gpu_success = np.empty((12, 4)), np.empty(12, dtype=np.bool_)
+        be_sho._sho_guess_batch(resp_re, resp_im, w_vec, 5, cpu_guess, cpu_success)
+        be_sho._sho_guess_batch_cuda(resp_re, resp_im, w_vec, 5, gpu_guess, gpu_success)
+        self.assertTrue(np.array_equal(gpu_success, cpu_success))
+        self.assertTrue(np.allclose(gpu_guess[cpu_success], cpu_guess[cpu_success]))
+
+    def test_out_strided_float32(self):
+        _, resp_mat = make_spectra(4)
+        results = np.zeros((4, 5), dtype=np.float32)
+        SHOestimateGuessBatch(resp_mat, w_vec, out=results[:, :4])
+        expected = np.array([SHOestimateGuess(resp_vec, w_vec) for resp_vec in resp_mat])
+        self.assertTrue(np.allclose(results[:, :4], expected, rtol=1E-6))
+
+
+class TestSHOrSquaredBatch(unittest.TestCase):
+
+    def test_matches_numpy(self):
+        _, resp_mat = make_spectra(20, noise=0.2)
+        guess_mat = SHOestimateGuessBatch(resp_mat, w_vec)
+        expected = np.empty(resp_mat.shape[0])
+        for spec_ind, resp_vec in enumerate(resp_mat):
+            ss_res = np.sum(np.abs(resp_vec - SHOfunc(guess_mat[spec_ind], w_vec)) ** 2)
+            ss_tot = np.sum(np.abs(resp_vec - np.mean(resp_vec)) ** 2)
+            expected[spec_ind] = 1 - ss_res / ss_tot
+        self.assertTrue(np.allclose(SHOrSquaredBatch(resp_mat, w_vec, guess_mat), expected))
+
+    def test_out_strided_float32(self):
+        _, resp_mat = make_spectra(10, noise=0.2)
+        results = np.zeros((10, 5), dtype=np.float32)
+        SHOestimateGuessBatch(resp_mat, w_vec, out=results[:, :4])
+        r_squared = SHOrSquaredBatch(resp_mat, w_vec, results[:, :4], out=results[:, 4])
+        self.assertTrue(np.shares_memory(r_squared, results))
+        expected = SHOrSquaredBatch(resp_mat, w_vec, results[:, :4].astype(np.float64))
+        self.assertTrue(np.allclose(results[:, 4], expected, rtol=1E-6))
+
+    def test_out_wrong_shape(self):
+        _, resp_mat = make_spectra(10)
+        guess_mat = SHOestimateGuessBatch(resp_mat, w_vec)
+        with self.assertRaises(ValueError):
+            SHOrSquaredBatch(resp_mat, w_vec, guess_mat, out=np.empty(9))
+        with self.assertRaises(ValueError):
+            SHOrSquaredBatch(resp_mat, w_vec, guess_mat, out=np.empty((10, 1)))
+
+    def test_constant_spectrum(self):
+        guess_mat = np.array([[1E-3, 310E+3, 100, 0]])
+        r_squared = SHOrSquaredBatch(np.ones((1, w_vec.size), dtype=np.complex128), w_vec, guess_mat)
+        self.assertEqual(r_squared[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()